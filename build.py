@@ -10,13 +10,15 @@
 
 import dataclasses
 import datetime as dt
+import functools
+import hashlib
 import operator
-import re
+import os
 import shutil
 import subprocess
 import sys
-import tempfile
-from collections.abc import Container
+from collections.abc import Container, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Final, NamedTuple, Self, final, override
 
@@ -25,17 +27,46 @@ import jinja2
 NAME = "numpy_typing_compat"
 REPO = "https://github.com/jorenham/numpy-typing-compat"
 
-# build number (patch version) as YYYYMMDD
-_TODAY = dt.datetime.now(tz=dt.UTC).date()
-BUILD = _TODAY.year * 10_000 + _TODAY.month * 100 + _TODAY.day
+# build number (patch version) as YYYYMMDD, which can be pinned with `NPTC_BUILD`,
+# and otherwise follows `SOURCE_DATE_EPOCH` (if set) for reproducible builds
+_TODAY = (
+    dt.datetime.fromtimestamp(int(_epoch), tz=dt.UTC)
+    if (_epoch := os.environ.get("SOURCE_DATE_EPOCH"))
+    else dt.datetime.now(tz=dt.UTC)
+).date()
+BUILD = int(
+    os.environ.get("NPTC_BUILD")
+    or _TODAY.year * 10_000 + _TODAY.month * 100 + _TODAY.day
+)
 
 DIR_ROOT = Path(__file__).parent
 DIR_DIST = DIR_ROOT / "dist"
 DIR_BUILD = DIR_ROOT / "build"
 DIR_TEMPLATES = DIR_ROOT / "templates"
-
+DIR_CACHE = DIR_ROOT / ".cache"
+
+# identical for all projects, so these are only read once
+_STATIC_FILES: Final = {
+    fname: (DIR_ROOT / fname).read_bytes() for fname in ("LICENSE", "README.md")
+}
+
+# The environment for all subprocesses. Note that `UV_CACHE_DIR` is deliberately left
+# alone, so that all `uv` calls share the user's (or CI's) warm cache. Unless it's
+# already set, `SOURCE_DATE_EPOCH` is pinned to the start of the (UTC) day, so that
+# rebuilding on the same day yields the same archives.
+_START_OF_DAY = dt.datetime.combine(_TODAY, dt.time(), tzinfo=dt.UTC)
+_ENV: Final = {
+    "SOURCE_DATE_EPOCH": str(int(_START_OF_DAY.timestamp())),
+    **os.environ,
+    "UV_NO_PROGRESS": "1",
+}
+
+# persist the compiled template bytecode across runs
+(DIR_CACHE / "jinja").mkdir(parents=True, exist_ok=True)
 JINJA_ENV = jinja2.Environment(
     loader=jinja2.FileSystemLoader(DIR_TEMPLATES),
+    bytecode_cache=jinja2.FileSystemBytecodeCache(str(DIR_CACHE / "jinja")),
+    auto_reload=False,
     keep_trailing_newline=True,
 )
 
@@ -44,6 +75,7 @@ JINJA_ENV = jinja2.Environment(
 class Flags:
     """Flags for the build script."""
 
+    force: bool = False
     keep: bool = False
     quiet: bool = False
     silent: bool = False
@@ -88,6 +120,7 @@ class DistInfo[T](NamedTuple):
     wheel: T
 
 
+@functools.cache
 def _get_template(fname: str, /) -> jinja2.Template:
     return JINJA_ENV.get_template(
         f"{fname}.jinja",
@@ -100,32 +133,43 @@ def _get_template(fname: str, /) -> jinja2.Template:
     )
 
 
+@functools.cache
+def _sources_digest() -> bytes:
+    # the source files are shared by all projects, so they're only hashed once
+    digest = hashlib.sha256()
+    for path in (Path(__file__), *sorted(DIR_TEMPLATES.glob("*.jinja"))):
+        with path.open("rb") as f:
+            digest.update(hashlib.file_digest(f, "sha256").digest())
+    for content in _STATIC_FILES.values():
+        digest.update(hashlib.sha256(content).digest())
+    return digest.digest()
+
+
 def _run_command(
-    *cmd: str,
+    *cmd: str | Path,
+    flags: Flags,
     cwd: str | Path | None = None,
-) -> subprocess.CompletedProcess[str]:
-    flags = Flags.from_args()
-
+) -> subprocess.CompletedProcess[bytes]:
     if not flags.quiet:
-        print(">>>", " ".join(cmd), file=sys.stderr)
+        print(">>>", *cmd, file=sys.stderr, flush=True)
 
+    # Unless quiet, the output goes straight to the terminal without passing through
+    # Python. Otherwise stdout is discarded, and stderr is only captured so that it
+    # can be reported if the command fails.
     completed = subprocess.run(
         cmd,
-        capture_output=True,
-        text=True,
+        stdout=subprocess.DEVNULL if flags.quiet else None,
+        stderr=subprocess.PIPE if flags.quiet else None,
         cwd=cwd,
+        env=_ENV,
         check=False,
     )
 
-    if not flags.quiet:
-        _ = sys.stdout.write(completed.stdout)
-        _ = sys.stderr.write(completed.stderr)
-
     try:
         completed.check_returncode()
     except subprocess.CalledProcessError:
         if flags.quiet:
-            _ = sys.stderr.write(completed.stderr)
+            _ = sys.stderr.write(completed.stderr.decode(errors="replace"))
         raise
 
     return completed
@@ -140,26 +184,37 @@ class Project:
         self.np_range = np_range
         self.py_range = py_range
 
-    @property
+    @functools.cached_property
     def version(self, /) -> str:
         return f"{BUILD}.{self.np_range[0].stable}"
 
-    @property
+    @functools.cached_property
     def name(self, /) -> str:
         return f"{NAME}-{self.version}"
 
-    @property
+    @functools.cached_property
     def project_path(self, /) -> Path:
         return DIR_BUILD / self.name
 
-    @property
+    @functools.cached_property
     def dist_paths(self, /) -> DistInfo[Path]:
         return DistInfo(
             sdist=DIR_DIST / f"{self.name}.tar.gz",
             wheel=DIR_DIST / f"{self.name}-py3-none-any.whl",
         )
 
-    @property
+    @functools.cached_property
+    def fingerprint_path(self, /) -> Path:
+        return DIR_CACHE / "fingerprints" / f"{self.name}.sha256"
+
+    @functools.cached_property
+    def fingerprint(self, /) -> str:
+        """A digest of all inputs that the built distributions depend on."""
+        digest = hashlib.sha256(_sources_digest())
+        digest.update(repr((self.np_range, self.py_range, BUILD)).encode())
+        return digest.hexdigest()
+
+    @functools.cached_property
     def const_name(self, /) -> str:
         return f"NUMPY_GE_{self.np_range[0].stable}".replace(".", "_")
 
@@ -172,132 +227,159 @@ class Project:
         clsname = type(self).__name__
         return f"<{clsname} np_range={self.np_range} py_range={self.py_range}>"
 
-    def _render_to_string(self, fname: str, /) -> str:
+    @functools.cached_property
+    def _context(self, /) -> dict[str, object]:
+        # the template context, shared by all templates of this project
         np_start, np_stop = self.np_range
         py_start, py_stop = self.py_range
-        context = {
+        return {
             "project": self,
             "np_start": np_start,
             "np_stop": np_stop,
             "py_start": py_start,
             "py_stop": py_stop,
         }
-        return _get_template(fname).render(**context)
-
-    def _run_command(self, /, *cmd: str) -> subprocess.CompletedProcess[str]:
-        return _run_command(*cmd, cwd=self.project_path)
-
-    def _lint_project(self, /) -> None:
-        # ruff check and format the generated code
-        for ruff_cmd in ("check", "format"):
-            _ = self._run_command(
-                "uvx",
-                "ruff",
-                ruff_cmd,
-                "--no-cache",
-                "--preview",
-                "--quiet",
-            )
-
-    def _create_project(self, /) -> None:
-        project_dir = self.project_path
-        project_dir.mkdir(parents=True, exist_ok=True)
-
-        for fname in ("LICENSE", "README.md"):
-            _ = shutil.copy2(str(DIR_ROOT / fname), str(project_dir / fname))
-
-        # pyproject.toml
-        pyproject_path = project_dir / "pyproject.toml"
-        _ = pyproject_path.write_text(self._render_to_string("pyproject.toml"))
-
-        # src/numpy_typing_compat/
-        module_dir = project_dir / "src" / NAME
+
+    def _render_to_string(self, fname: str, /) -> str:
+        return _get_template(fname).render(self._context)
+
+    def _render_files(self, /) -> dict[str, bytes]:
+        # the contents of the rendered files, relative to the project directory
+        return {
+            "pyproject.toml": self._render_to_string("pyproject.toml").encode(),
+            f"src/{NAME}/__init__.py": self._render_to_string("__init__.py").encode(),
+        }
+
+    def create(self, /) -> None:
+        """Generate the project files in the build directory."""
+        # render the templates in memory first, so that the files are written in one go
+        files = self._render_files()
+
+        # src/numpy_typing_compat/ (this also creates the project directory)
+        module_dir = self.project_path / "src" / NAME
         module_dir.mkdir(parents=True, exist_ok=True)
 
         # src/numpy_typing_compat/py.typed
-        py_typed_path = module_dir / "py.typed"
-        _ = py_typed_path.write_text("")
-
-        # src/numpy_typing_compat/__init__.py
-        init_file = module_dir / "__init__.py"
-        _ = init_file.write_text(self._render_to_string("__init__.py"))
-
-        self._lint_project()
-
-    def _validate_wheel(self, /) -> None:
-        py_flag = f"--python={self.py_range[0]}"
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # create a temporary uv project
-            _ = _run_command(
-                "uv",
-                "init",
-                "--bare",
-                "--no-cache",
-                "--name=nptc-test",
-                py_flag,
-                cwd=tmpdir,
-            )
-
-            # install the wheel
-            wheel = str(self.dist_paths.wheel)
-            _ = _run_command("uv", "add", py_flag, wheel, cwd=tmpdir)
-
-            # try to import the package, and ensure satisfiable version constraints
-            _ = _run_command(
-                "uv",
-                "run",
-                py_flag,
-                "python",
-                "-c",
-                f"import {NAME} as nptc; assert nptc._check_version()",
-                cwd=tmpdir,
-            )
-
-            # validate the static type annotations
-            pyright = "basedpyright"
-            _ = _run_command("uv", "add", py_flag, pyright, cwd=tmpdir)
-            _ = _run_command(
-                "uv",
-                "run",
-                py_flag,
-                pyright,
-                "--level=warning",
-                "--ignoreexternal",
-                f"--verifytypes={NAME}",
-                cwd=tmpdir,
-            )
-
-    def build(self, /) -> None:
-        """Create and `uv build` the projects."""
-        self._create_project()
-
-        completed = self._run_command("uv", "build", f"--out-dir={DIR_DIST}")
+        (module_dir / "py.typed").touch()
+
+        # LICENSE and README.md are identical for all projects, so these are hard-linked
+        # if possible, and otherwise written from the cached contents
+        for fname, content in _STATIC_FILES.items():
+            path = self.project_path / fname
+            path.unlink(missing_ok=True)
+            try:
+                path.hardlink_to(DIR_ROOT / fname)
+            except OSError:
+                _ = path.write_bytes(content)
+
+        for fname, content in files.items():
+            _ = (self.project_path / fname).write_bytes(content)
+
+    def _validate_wheel(self, /, flags: Flags) -> None:
+        # Both commands run in the same ephemeral environment with the wheel and
+        # basedpyright installed, so that it's only resolved and installed once.
+        # They run from the dist directory, which doesn't contain any Python sources
+        # or configuration files that could be picked up instead of the wheel.
+        uv_run = (
+            "uv",
+            "run",
+            "--isolated",
+            "--no-project",
+            f"--python={self.py_range[0]}",
+            f"--with={self.dist_paths.wheel}",
+            "--with=basedpyright",
+        )
+
+        # try to import the package, and ensure satisfiable version constraints
+        _ = _run_command(
+            *uv_run,
+            "python",
+            "-c",
+            f"import {NAME} as nptc; assert nptc._check_version()",
+            flags=flags,
+            cwd=DIR_DIST,
+        )
+
+        # validate the static type annotations
+        _ = _run_command(
+            *uv_run,
+            "basedpyright",
+            "--level=warning",
+            "--ignoreexternal",
+            f"--verifytypes={NAME}",
+            flags=flags,
+            cwd=DIR_DIST,
+        )
+
+    def build(self, /, flags: Flags) -> None:
+        """`uv build` the created project, and validate the wheel."""
+        # remove any leftovers, so that they can't be mistaken for the new build, and
+        # so that a fingerprint only exists once the new build has been validated
+        self.fingerprint_path.unlink(missing_ok=True)
+        for path in self.dist_paths:
+            path.unlink(missing_ok=True)
+
+        # the output paths follow from `--out-dir` and the project name and version
+        _ = _run_command(
+            "uv",
+            "build",
+            "--quiet",
+            f"--out-dir={DIR_DIST}",
+            self.project_path,
+            flags=flags,
+        )
 
         # verify that the build was successful
-        paths: list[Path] = []
-        for match in re.finditer(r"Successfully built (/[\w\-\./]+)", completed.stderr):
-            out_path = Path.cwd() / match.group(1)
-            assert out_path.is_file(), out_path
-            paths.append(out_path)
-
-        if not paths:
-            exc = RuntimeError("No files were built, check the output of `uv build`.")
-            for line in completed.stderr.splitlines():
-                exc.add_note(line)
+        if missing := [path for path in self.dist_paths if not path.is_file()]:
+            exc = RuntimeError("Not all files were built, check the `uv build` config.")
+            for path in missing:
+                exc.add_note(f"missing: {path}")
             raise exc
 
-        assert len(paths) == 2, paths
+        self._validate_wheel(flags)
+
+        self.fingerprint_path.parent.mkdir(parents=True, exist_ok=True)
+        _ = self.fingerprint_path.write_text(self.fingerprint)
 
-        path_wheel, path_sdist = paths
-        if path_wheel.suffix != ".whl":
-            path_wheel, path_sdist = path_sdist, path_wheel
+    def is_fresh(self, /) -> bool:
+        """Whether the distributions were already built from the current inputs."""
+        if not all(path.is_file() for path in self.dist_paths):
+            return False
 
-        paths_expect = self.dist_paths
-        assert path_sdist == paths_expect.sdist, (path_sdist, paths_expect.sdist)
-        assert path_wheel == paths_expect.wheel, (path_wheel, paths_expect.wheel)
+        try:
+            fingerprint = self.fingerprint_path.read_text()
+        except FileNotFoundError:
+            return False
 
-        self._validate_wheel()
+        return fingerprint == self.fingerprint
+
+
+def _lint_projects(projects: Sequence[Project], flags: Flags, /) -> None:
+    # ruff check and format the generated code of all projects at once
+    paths = [project.project_path for project in projects]
+
+    # ruff only infers the target version from `requires-python` in the nearest
+    # `pyproject.toml` of the working directory, so pass them explicitly
+    target_versions = ", ".join(
+        f'"{project.name}/**" = "py{py_start.major}{py_start.minor}"'
+        for project in projects
+        for py_start in [project.py_range[0]]
+    )
+    config = f"per-file-target-version = {{ {target_versions} }}"
+
+    for ruff_cmd in ("check", "format"):
+        _ = _run_command(
+            "uvx",
+            "ruff",
+            ruff_cmd,
+            "--no-cache",
+            "--preview",
+            "--quiet",
+            f"--config={config}",
+            *paths,
+            flags=flags,
+            cwd=DIR_BUILD,
+        )
 
 
 PROJECTS = [
@@ -332,8 +414,23 @@ def main(*args: str) -> int:
     flags = Flags.from_args(set(args))
     cwd = Path.cwd()
 
+    stale = PROJECTS if flags.force else [p for p in PROJECTS if not p.is_fresh()]
+
+    for project in stale:
+        project.create()
+    if stale:
+        _lint_projects(stale, flags)
+
+    # the concurrent `uv build` calls all write to the same output directory
+    DIR_DIST.mkdir(parents=True, exist_ok=True)
+
+    # the projects are independent, and most of the time is spent waiting for
+    # subprocesses, so a thread pool is sufficient
+    max_workers = min(len(PROJECTS), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        _ = list(executor.map(functools.partial(Project.build, flags=flags), stale))
+
     for project in PROJECTS:
-        project.build()
         paths = project.dist_paths
 
         if not flags.silent: